@@ -1,3 +1,4 @@
+import io
 import os
 import sys
 import time
@@ -7,124 +8,265 @@ import threading
 import queue
 import datetime
 import platform
+import traceback
 
-import pexpect
 import cronevents.event_manager
+import cronevents.event_run
 import buelon.helpers.sqlite3_helper
 import buelon.helpers.postgres
 
 
 LOG_CRON_EVENT_LOGS = os.environ.get('LOG_CRON_EVENT_LOGS', None) == 'true'
 
+LOG_BATCH_SIZE = 100  # flush once this many lines are pending
+LOG_FLUSH_INTERVAL = 1.  # seconds between flushes while lines keep trickling in
+LOG_RING_SIZE = 65536  # lines buffered between the reader and the logger thread before dropping
+LOG_BUFFERS = 4  # batch buffers handed back and forth between the logger and writer threads
+READ_CHUNK_SIZE = 65536  # bytes read from the event's output at a time
+# events the dispatcher runs at once, extra triggers wait for a free slot (0 = no limit)
+MAX_RUNNING_EVENTS = int(os.environ.get('CRON_EVENTS_WORKERS', None) or 0)
+
+
+class SPSCRing:
+    """
+    Fixed-size single-producer/single-consumer ring buffer.
+
+    Only the producer calls `put` and only the consumer calls `drain`. Each side owns one index,
+    so no lock is needed. When full, `put` drops the item instead of blocking the producer.
+    """
+    def __init__(self, size: int = LOG_RING_SIZE):
+        self.size = size
+        self.buf = [None] * size
+        self.head = 0  # next slot to read, owned by the consumer
+        self.tail = 0  # next slot to write, owned by the producer
+        self.dropped = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def put(self, item) -> bool:
+        if self.tail - self.head >= self.size:
+            self.dropped += 1
+            return False
+        self.buf[self.tail % self.size] = item
+        self.tail += 1
+        return True
+
+    def drain(self) -> list:
+        head, tail, size = self.head, self.tail, self.size
+        items = []
+        for i in range(head, tail):
+            items.append(self.buf[i % size])
+            self.buf[i % size] = None
+        self.head = tail
+        return items
+
 
 class EventLogger:
     def __init__(self, event_id):
         self.event_id = event_id
-        self.db = cronevents.event_manager.get_db()
-
-        self.queue = queue.Queue()
+        try:
+            prepare_log_table(cronevents.event_manager.get_db(), event_id)
+        except Exception as e:  # retried by the first upload
+            print('error preparing log table', e)
+
+        # single producer (`log`) and single consumer (`logger`)
+        self.ring = SPSCRing()
+        self.reported_dropped = 0
+        self.has_logs = threading.Event()
+        self.stopped = threading.Event()
         self.current_index = -1
         self.last_log = time.time()
 
+        # `logger` fills a buffer and hands it to `writer` through `full_buffers`,
+        # `writer` uploads it and hands it back empty through `empty_buffers`
+        self.full_buffers = queue.Queue()
+        self.empty_buffers = queue.Queue()
+        for _ in range(LOG_BUFFERS):
+            self.empty_buffers.put([])
+
         self.thread = None
+        self.writer_thread = None
 
     def start_logger(self):
+        self.writer_thread = threading.Thread(target=self.writer)
+        self.writer_thread.start()
         self.thread = threading.Thread(target=self.logger)
         self.thread.start()
 
     def stop_logger(self):
-        self.queue.put(None)
+        self.stopped.set()
+        self.has_logs.set()
         if self.thread:
             self.thread.join()
             self.thread = None
+        if self.writer_thread:
+            self.writer_thread.join()
+            self.writer_thread = None
 
     def __del__(self):
         self.stop_logger()
 
     def create_row(self, logs: list[str] | list[tuple[str, float]]):
+        batch_time = time.time()
+        last_t, utc_time = None, None
         for log in logs:
             self.current_index += 1
 
             if isinstance(log, tuple):
                 log, t = log
             else:
-                t = time.time()
+                t = batch_time
+
+            # lines drained together share a timestamp, so only build a new datetime when it changes
+            if t != last_t:
+                last_t, utc_time = t, datetime.datetime.fromtimestamp(t, tz=datetime.timezone.utc)
 
             yield {
                 'event_id': self.event_id,
                 'index': self.current_index,
                 'line': log,
                 # 'epoch': t,
-                'utc_time': datetime.datetime.fromtimestamp(time.time(), tz=datetime.timezone.utc),  # datetime.datetime.fromtimestamp(t, datetime.UTC)
+                'utc_time': utc_time,
             }
 
     def upload(self, logs: list[str] | list[tuple[str, float]]):
         table = list(self.create_row(logs))
-        try:
-            upload_logs(self.db, self.event_id, table)
-        except:
-            self.db = cronevents.event_manager.get_db()
-            upload_logs(self.db, self.event_id, table)
+        cronevents.event_manager.retry_db(lambda db: upload_logs(db, self.event_id, table))
 
     def log(self, s):
-        self.queue.put(s)
+        self.ring.put(s)
+        self.has_logs.set()
 
-    def logger(self):
-        current_log = []
+    def writer(self):
         while True:
-            log = self.queue.get()
-            if log is None:
+            buffer = self.full_buffers.get()
+            if buffer is None:
                 break
 
-            current_log.append((log, time.time()))
+            try:
+                self.upload(buffer)
+            except Exception as e:
+                print('error uploading logs', e)
+            buffer.clear()
+            self.empty_buffers.put(buffer)
+
+    def logger(self):
+        current_log = self.empty_buffers.get()
+        while True:
+            self.has_logs.wait(LOG_FLUSH_INTERVAL)
+            self.has_logs.clear()
+
+            # drain everything that is pending in one go
+            t = time.time()
+            current_log.extend((log, t) for log in self.ring.drain())
 
-            if time.time() - self.last_log > 1 or len(current_log) > 100:
-                self.upload(current_log)
-                current_log = []
+            dropped = self.ring.dropped
+            if dropped != self.reported_dropped:
+                current_log.append((f'[cronevents] dropped {dropped - self.reported_dropped} log lines', t))
+                self.reported_dropped = dropped
+
+            if current_log and (time.time() - self.last_log > LOG_FLUSH_INTERVAL or len(current_log) >= LOG_BATCH_SIZE):
+                self.full_buffers.put(current_log)
+                current_log = self.empty_buffers.get()
                 self.last_log = time.time()
 
+            if self.stopped.is_set() and not self.ring:
+                break
+
         if current_log:
-            self.upload(current_log)
+            self.full_buffers.put(current_log)
+        self.full_buffers.put(None)
 
 
-def upload_logs(db, event_id, logs):
-    if logs:
-        kwargs = {}
-        index_query = 'create index if not exists event_logs_event_id_idx on cron_events_log (event_id);'
-        if isinstance(db, buelon.helpers.postgres.Postgres):
-            index_query = 'create index if not exists event_logs_event_id_idx on cron_events_log using hash (event_id);'
-            kwargs['partition'] = 'event_id'
-            kwargs['partition_query'] = f'''CREATE TABLE if not exists "cron_events_log_{event_id}" 
-                                    PARTITION OF "cron_events_log" FOR VALUES IN ('{event_id}');'''
+LOG_COLUMNS = ('event_id', 'index', 'line', 'utc_time')
+SQLITE_INSERT_LOGS = '''INSERT OR REPLACE INTO cron_events_log ("event_id", "index", "line", "utc_time")
+                        VALUES (?, ?, ?, ?);'''
+POSTGRES_COPY_LOGS = '''COPY cron_events_log ("event_id", "index", "line", "utc_time")
+                        FROM STDIN WITH (FORMAT text)'''
 
-        db.upload_table(
-            f'cron_events_log',
-            logs,
-            id_column=['event_id', 'index'],
-            **kwargs
-        )
-        db.query(index_query)
+# event ids whose log table, partition and index were already created by this process
+_PREPARED_LOG_TABLES: set[str] = set()
 
 
-def main():
-    try:
-        # get event id
-        event_id = sys.argv[-5]
+def prepare_log_table(db, event_id):
+    if event_id in _PREPARED_LOG_TABLES:
+        return
 
-        # get module
-        og_module = module = sys.argv[-4]
+    if isinstance(db, buelon.helpers.postgres.Postgres):
+        db.query('''CREATE TABLE if not exists "cron_events_log" (
+                        "event_id" text, "index" integer, "line" text, "utc_time" timestamptz,
+                        PRIMARY KEY ("event_id", "index")
+                    ) PARTITION BY LIST ("event_id");''')
+        db.query(f'''CREATE TABLE if not exists "cron_events_log_{event_id}"
+                        PARTITION OF "cron_events_log" FOR VALUES IN ('{event_id}');''')
+        db.query('create index if not exists event_logs_event_id_idx on cron_events_log using hash (event_id);')
+    else:
+        db.query('''CREATE TABLE if not exists "cron_events_log" (
+                        "event_id", "index", "line", "utc_time",
+                        PRIMARY KEY ("event_id", "index")
+                    );''')
+        db.query('create index if not exists event_logs_event_id_idx on cron_events_log (event_id);')
 
-        # get function name
-        func = sys.argv[-3]
+    _PREPARED_LOG_TABLES.add(event_id)
 
-        # get args
-        args = sys.argv[-2]
 
-        # get kwargs
-        kwargs = sys.argv[-1]
+def copy_text_value(value) -> str:
+    # escaping for postgres `COPY ... WITH (FORMAT text)`, which cannot hold NUL characters
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+            .replace('\x00', ''))
 
-        # print(module, func, args, kwargs)
 
+def upload_logs(db, event_id, logs):
+    if logs:
+        prepare_log_table(db, event_id)
+        rows = [tuple(log[c] for c in LOG_COLUMNS) for log in logs]
+
+        if isinstance(db, buelon.helpers.postgres.Postgres):
+            buf = io.StringIO()
+            for row in rows:
+                buf.write('\t'.join(copy_text_value(v) for v in row))
+                buf.write('\n')
+            buf.seek(0)
+
+            conn = db.connect()
+            try:
+                with conn, conn.cursor() as cur:
+                    cur.copy_expert(POSTGRES_COPY_LOGS, buf)
+            finally:
+                conn.close()
+        else:
+            conn = db.conn
+            try:
+                with conn:
+                    conn.executemany(SQLITE_INSERT_LOGS, rows)
+            finally:
+                conn.close()
+
+
+_EVENT_ENV: dict | None = None
+_EVENT_ENV_SIZE = -1
+
+
+def event_env() -> dict:
+    """
+    Environment for event processes, `PYTHONUNBUFFERED` so output streams as it is printed.
+    The dispatcher reuses one copy until variables are added to or removed from `os.environ`.
+    """
+    global _EVENT_ENV, _EVENT_ENV_SIZE
+    if _EVENT_ENV is None or _EVENT_ENV_SIZE != len(os.environ):
+        _EVENT_ENV = {**os.environ, 'PYTHONUNBUFFERED': '1'}
+        _EVENT_ENV_SIZE = len(os.environ)
+    return _EVENT_ENV
+
+
+def run_event(event_id, module, func, args, kwargs):
+    """
+    Runs `module.func` in a fresh interpreter, logging its output when `LOG_CRON_EVENT_LOGS` is set.
+    `args` and `kwargs` are `cronevents.event_run` json arguments: inline base64 or a temp file path,
+    which is removed once the event is done.
+    """
+    try:
         script = '-c "import cronevents.event_run;cronevents.event_run.main()"'  # os.path.join(os.getcwd(), 'event_run.py')
         cmd = f'{sys.executable} {script} {module} {func} {args} {kwargs}'
 
@@ -133,24 +275,41 @@ def main():
             logger.start_logger()
 
         if platform.system() != 'Windows':
-            p = pexpect.spawn(
-                cmd,
+            process = subprocess.Popen(
+                shlex.split(cmd),
+                stdout=subprocess.PIPE if LOG_CRON_EVENT_LOGS else subprocess.DEVNULL,
+                stderr=subprocess.STDOUT,
                 cwd=os.getcwd(),
-                env=dict(os.environ),
-                timeout=60 * 60 * 24 * 7,  # 1 week
+                env=event_env(),
+                bufsize=0,
             )
 
-            while not p.eof():
-                line = p.readline()
-                if LOG_CRON_EVENT_LOGS:
-                    logger.log(line.decode('utf-8').strip())
+            if not LOG_CRON_EVENT_LOGS:
+                process.wait()
+            else:
+                # read whatever is available and split it into lines here,
+                # carrying a trailing partial line over to the next chunk
+                fd = process.stdout.fileno()
+                tail = b''
+                while True:
+                    chunk = os.read(fd, READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    lines = (tail + chunk).split(b'\n')
+                    tail = lines.pop()
+                    for line in lines:
+                        logger.log(line.decode('utf-8', errors='replace').strip())
+                if tail:
+                    logger.log(tail.decode('utf-8', errors='replace').strip())
+                process.stdout.close()
+                process.wait()
         else:
             process = subprocess.Popen(
                 shlex.split(cmd),
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
                 cwd=os.getcwd(),
-                env=dict(os.environ)
+                env=event_env(),
             )
 
             if not LOG_CRON_EVENT_LOGS:
@@ -166,14 +325,46 @@ def main():
         if LOG_CRON_EVENT_LOGS:
             logger.stop_logger()
     finally:
-        try:
-            os.remove(sys.argv[-2])
-        except:
-            pass
-        try:
-            os.remove(sys.argv[-1])
-        except:
-            pass
+        cronevents.event_run.remove_json_arg(args)
+        cronevents.event_run.remove_json_arg(kwargs)
+
+
+def run_job(slots, event_id, module, func, args, kwargs):
+    if slots is not None:
+        slots.acquire()
+    try:
+        run_event(event_id, module, func, args, kwargs)
+    except Exception as e:
+        print('error running event', event_id, module, func, e)
+        traceback.print_exc()
+    finally:
+        if slots is not None:
+            slots.release()
+
+
+def dispatcher():
+    """
+    Long-lived process started by the event manager in its own session. Reads one tab separated
+    job per line from stdin and supervises each event in its own thread, so no interpreter is
+    started per trigger just to supervise the event. At most `MAX_RUNNING_EVENTS` run at once
+    when it is set; the others wait for a slot in their thread, so stdin keeps being read and
+    the manager never blocks on a full pipe. Once stdin closes (the manager exited) it stops
+    taking jobs and exits after the running events finish.
+    """
+    slots = threading.BoundedSemaphore(MAX_RUNNING_EVENTS) if MAX_RUNNING_EVENTS > 0 else None
+    for line in sys.stdin:
+        job = line.rstrip('\n').split('\t')
+        if len(job) != 5:
+            print('invalid event job', repr(line))
+            continue
+        threading.Thread(target=run_job, args=(slots, *job)).start()
+
+
+def main():
+    # get event id, module, function name, args and kwargs
+    run_event(*sys.argv[-5:])
+
+
 
 
 if __name__ == '__main__':
@@ -1,20 +1,28 @@
 import math
 import inspect
 import time
-import sys
-import subprocess
-import shlex
-import json
+import base64
+import platform
 import uuid
 import os
 import datetime
 import traceback
+import json
 import enum
+import re
+import sqlite3
+import threading
+import subprocess
+import sys
+import functools
+import typing
 
 import dotenv
 import buelon.helpers.sqlite3_helper
 import buelon.helpers.postgres
 
+import cronevents.event_run
+
 
 dotenv.load_dotenv('.env')
 
@@ -28,10 +36,45 @@ LOG_CRON_EVENT_TRIGGERS = os.environ.get('LOG_CRON_EVENT_TRIGGERS', None) == 'tr
 DEFAULT_DB = buelon.helpers.sqlite3_helper.Sqlite3(
     location=os.path.join('.cronevents', 'event_manager.db')
 )
+# built once by `get_db`, dropped by `reset_db` after connection errors
+_DB = None
+DB_CONNECTION_ERRORS = (buelon.helpers.postgres.psycopg2.OperationalError, buelon.helpers.postgres.psycopg2.InterfaceError)
+# sqlite `OperationalError`s worth retrying, it also raises them for missing tables and bad sql
+SQLITE_BUSY_MESSAGES = ('database is locked', 'database table is locked', 'database is busy')
+DB_RETRIES = 5
+DB_MIN_BACKOFF = .5
+DB_MAX_BACKOFF = 30.
+
 DAYS_OF_THE_WEEK = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+SECONDS_PER_DAY = 86400
+
+POLL_INTERVAL = 2.  # seconds between polls while any weekday/`@` event is registered
+MIN_POLL_DELAY = .1
+MAX_POLL_DELAY = 60.
+
+# set to wake `main` before its computed delay runs out
+WAKE_UP = threading.Event()
+
+# process that runs triggered events, see `cronevents.event.dispatcher`
+_DISPATCHER: subprocess.Popen | None = None
 
 STARTING_TOKENS = ['every', 'in', 'on']
 
+# args/kwargs up to this many base64 characters are passed on the command line instead of a temp file
+# (windows limits the whole command line to 32767 characters)
+MAX_INLINE_JSON_ARG = 8_000 if platform.system() == 'Windows' else 120_000
+
+# fast paths for `query_syntax_checker`, anything they do not match goes through the token checks
+_UNIT_PATTERN = r'(?:day|hour|minute|second)s?'
+_STARTING_TOKEN_RE = re.compile(r'(' + '|'.join(STARTING_TOKENS) + ') ')
+_DAYS_RE = re.compile('|'.join(DAYS_OF_THE_WEEK))
+_AT_TIME_RE = re.compile(r'\s*\d+(?::\d+){0,2}(?:\s*(?:am|pm)|\s*)')
+_INTERVAL_RE = re.compile(rf'\s*\d+\s+{_UNIT_PATTERN}(?:\s+\d+\s+{_UNIT_PATTERN})*\s*')
+
+# (word before the unit, unit) pairs for `parse_time`
+_TIME_UNIT_RE = re.compile(r'(\S*?)\s*(day|hour|minute|second)')
+UNIT_SECONDS = {'day': 86400, 'hour': 3600, 'minute': 60, 'second': 1}
+
 
 class Tokens(enum.Enum):
     """
@@ -41,6 +84,37 @@ class Tokens(enum.Enum):
     AT: str = '@'
 
 
+class QueryKind(enum.IntEnum):
+    """
+    Kinds of cron event queries, used to pick the `READY` function for a `Schedule`.
+    """
+    OR = 0  # query || query
+    DAY = 1  # every weekday [@ time]
+    AT = 2  # every n days @ time
+    EVERY = 3  # every n units
+
+
+class Schedule(typing.NamedTuple):
+    """
+    A query parsed once into the numbers `ready` compares against.
+    """
+    kind: QueryKind
+    interval: float = 0.  # seconds between runs (EVERY, AT)
+    at: int | None = None  # utc seconds into the day, None when the time is invalid (AT) or not set (DAY)
+    days: int = 0  # whole days that must pass between runs (AT)
+    weekdays: frozenset = frozenset()  # `time.struct_time.tm_wday` values (DAY)
+    parts: tuple = ()  # the `||` separated schedules (OR)
+
+
+class PollTime(typing.NamedTuple):
+    """
+    The current time, computed once per poll and shared by every row.
+    """
+    epoch: float
+    utc: time.struct_time
+    local_day: int  # days since the epoch in local time
+
+
 class CronEventError(Exception):
     """
     Exception for cron event errors.
@@ -54,9 +128,50 @@ class CronEventSyntaxError(CronEventError):
 
 
 def get_db():
-    if USING_POSTGRES:
-        return buelon.helpers.postgres.get_postgres_from_env()
-    return DEFAULT_DB
+    global _DB
+    if _DB is None:
+        _DB = buelon.helpers.postgres.get_postgres_from_env() if USING_POSTGRES else DEFAULT_DB
+    return _DB
+
+
+def reset_db():
+    """
+    Drops the cached database so the next `get_db` builds a new one.
+    """
+    global _DB
+    _DB = None
+
+
+def is_db_connection_error(e: Exception) -> bool:
+    """
+    Whether `e` is a connection failure (or a busy sqlite database) that is worth retrying.
+    """
+    if isinstance(e, sqlite3.OperationalError):
+        return any(m in str(e) for m in SQLITE_BUSY_MESSAGES)
+    return isinstance(e, DB_CONNECTION_ERRORS)
+
+
+def is_missing_table_error(e: Exception) -> bool:
+    if isinstance(e, sqlite3.OperationalError):
+        return 'no such table' in str(e)
+    return isinstance(e, buelon.helpers.postgres.psycopg2.errors.UndefinedTable)
+
+
+def retry_db(func, retries: int = DB_RETRIES):
+    """
+    Calls `func(get_db())`, re-creating the database with capped exponential backoff
+    when the connection fails.
+    """
+    delay = DB_MIN_BACKOFF
+    for attempt in range(retries):
+        try:
+            return func(get_db())
+        except Exception as e:
+            if not is_db_connection_error(e) or attempt == retries - 1:
+                raise
+            reset_db()
+            time.sleep(delay)
+            delay = min(delay * 2, DB_MAX_BACKOFF)
 
 
 def try_isnan(v):
@@ -91,6 +206,9 @@ def try_number(value, _type=float, on_fail_return_value=None, asignment=None, na
 
 
 def query_at_time_syntax_checker(at: str):
+    if _AT_TIME_RE.fullmatch(at):
+        return
+
     has_pm = False
     if 'am' in at:
         if 'pm' in at:
@@ -136,6 +254,22 @@ def query_syntax_checker(query: str) -> None:
     if not isinstance(query, str):
         raise CronEventSyntaxError('Query must be a string')
 
+    error = _cached_query_syntax_check(query)
+    if error is not None:
+        raise CronEventSyntaxError(*error.args)
+
+
+@functools.lru_cache(maxsize=4096)
+def _cached_query_syntax_check(query: str) -> CronEventSyntaxError | None:
+    # queries are checked on every poll, so remember the verdict per query string
+    try:
+        _query_syntax_checker(query)
+    except CronEventSyntaxError as e:
+        return e
+    return None
+
+
+def _query_syntax_checker(query: str) -> None:
     if '||' in query:
         queries = query.split('||')
         for q in queries:
@@ -146,13 +280,11 @@ def query_syntax_checker(query: str) -> None:
         return
 
     query = query.lower()
-    if not any(query.strip().startswith(f'{token} ') for token in STARTING_TOKENS):  # not query.strip().startswith('every'):
+    match = _STARTING_TOKEN_RE.match(query.strip())
+    if not match:  # not query.strip().startswith('every'):
         raise CronEventSyntaxError('Query must start with one: ' + ', '.join(STARTING_TOKENS))
 
-    for token in STARTING_TOKENS:
-        if query.strip().startswith(f'{token} '):
-            query = query.replace(f'{token} ', '', 1)
-            break
+    query = query.replace(f'{match.group(1)} ', '', 1)
     # query = query.replace('every', '').strip()
 
     if '@' in query:
@@ -161,14 +293,17 @@ def query_syntax_checker(query: str) -> None:
         query, at = query.split('@')
         query_at_time_syntax_checker(at)
 
-    for day in DAYS_OF_THE_WEEK:
-        if day in query:
-            if query.count(day) > 1:
-                raise CronEventSyntaxError(f'Only one {day} is allowed')
-            if '' != query.replace(day, '').strip():
-                raise CronEventSyntaxError(f'Invalid format. Using day of the week cannot contain other values. (remove: `{query.replace(day, "")}` from `{query}`')
-            else:
-                return
+    days = _DAYS_RE.findall(query)
+    if days:
+        day = min(days, key=DAYS_OF_THE_WEEK.index)
+        if query.count(day) > 1:
+            raise CronEventSyntaxError(f'Only one {day} is allowed')
+        if '' != query.replace(day, '').strip():
+            raise CronEventSyntaxError(f'Invalid format. Using day of the week cannot contain other values. (remove: `{query.replace(day, "")}` from `{query}`')
+        return
+
+    if _INTERVAL_RE.fullmatch(query):
+        return
 
     units = ['day', 'hour', 'minute', 'second']
     units += [f'{u}s' for u in units]
@@ -228,20 +363,48 @@ def temp_file_name():
 def temp_save_json(data):
     filename = temp_file_name()
     with open(filename, 'w') as f:
-        json.dump(data, f)
+        f.write(json.dumps(data))
     return filename
 
 
+def json_arg(data) -> str:
+    encoded = base64.b64encode(json.dumps(data).encode()).decode()
+    if len(encoded) < MAX_INLINE_JSON_ARG:
+        return cronevents.event_run.JSON_ARG_PREFIX + encoded
+    return temp_save_json(data)
+
+
+def start_dispatcher() -> subprocess.Popen:
+    """
+    Starts (or restarts a dead) event dispatcher. It runs in its own session so events it is
+    running keep going when the manager exits or is interrupted.
+    """
+    global _DISPATCHER
+    if _DISPATCHER is None or _DISPATCHER.poll() is not None:
+        _DISPATCHER = subprocess.Popen(
+            [sys.executable, '-c', 'import cronevents.event;cronevents.event.dispatcher()'],
+            stdin=subprocess.PIPE,
+            text=True,
+            start_new_session=True,
+        )
+    return _DISPATCHER
+
+
 def invoke(module, func, args, kwargs):
+    global _DISPATCHER
     event_id = f'e{uuid.uuid1().hex}'
-    script = '-c "import cronevents.event;cronevents.event.main()"'  # os.path.join(os.getcwd(), 'event.py')
-    cmd = f'{sys.executable} {script} {event_id} {module} {func} {temp_save_json(args)} {temp_save_json(kwargs)}'
-    print('running', datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), module, func)  # , f'"{cmd}"')
+    print('running', datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), module, func)
 
-    subprocess.Popen(
-        shlex.split(cmd),
-        env=dict(os.environ)
-    )
+    job = '\t'.join([event_id, module, func, json_arg(args), json_arg(kwargs)]) + '\n'
+    try:
+        dispatcher = start_dispatcher()
+        dispatcher.stdin.write(job)
+        dispatcher.stdin.flush()
+    except OSError:  # the dispatcher died since the last check
+        _DISPATCHER = None
+        dispatcher = start_dispatcher()
+        dispatcher.stdin.write(job)
+        dispatcher.stdin.flush()
 
     if LOG_CRON_EVENT_TRIGGERS:
         get_db().upload_table('cron_event_triggers', [{
@@ -258,7 +421,7 @@ def invoke(module, func, args, kwargs):
 
 
 def create_event(module, func, args, kwargs, query):
-    get_db().upload_table('cronevents', [{
+    row = {
         'id': f'{module}|{func}',
         'query': query,
         'last': datetime.datetime.fromtimestamp(time.time(), tz=datetime.timezone.utc),  # datetime.datetime.fromtimestamp(time.time(), datetime.UTC),
@@ -266,36 +429,28 @@ def create_event(module, func, args, kwargs, query):
         'func': func,
         'args': json.dumps(args),
         'kwargs': json.dumps(kwargs),
-    }], id_column='id')
-
-
-def get_word_before_word(word: str, txt: str):
-    if word not in txt:
-        return ''
-    return txt.split(word)[0].strip().split(' ')[-1].strip().split('\n')[-1].strip().split('\t')[-1].strip()
+    }
+    row['next_run_ts'] = next_run_ts(row)
+    get_db().upload_table('cronevents', [row], id_column='id')
 
 
+@functools.lru_cache(maxsize=4096)
 def parse_time(s: str):
     m = 0
     if 'minus' in s:
-        m = parse_time(s.split('minus')[-1])
-        s = s.split('minus')[0]
+        m = parse_time(s.rpartition('minus')[2])
+        s = s.partition('minus')[0]
     v = 0
-    if 'day' in s:
-        x = try_number(get_word_before_word('day', s), on_fail_return_value=1.0)
-        v += 86400 * x
-    if 'hour' in s:
-        x = try_number(get_word_before_word('hour', s), on_fail_return_value=1.0)
-        v += 3600 * x
-    if 'minute' in s:
-        x = try_number(get_word_before_word('minute', s), on_fail_return_value=1.0)
-        v += 60 * x
-    if 'second' in s:
-        x = try_number(get_word_before_word('second', s), on_fail_return_value=1.0)
-        v += x
+    seen = set()
+    # only the first use of each unit counts, a missing or invalid number means 1
+    for number, unit in _TIME_UNIT_RE.findall(s):
+        if unit not in seen:
+            seen.add(unit)
+            v += UNIT_SECONDS[unit] * try_number(number, on_fail_return_value=1.0)
     return (v if v > 0 else 86400) - m
 
 
+@functools.lru_cache(maxsize=4096)
 def parse_time_timedelta(s: str):
     def force_int(x):
         return try_number(x, _type=int, on_fail_return_value=0)
@@ -303,8 +458,8 @@ def parse_time_timedelta(s: str):
     def strip_list(l):
         return [x.strip() for x in l]
 
-    query = s.split('@')[-1]
-    q = query.lower().split('am')[0].split('pm')[0]
+    query = s[s.rfind('@') + 1:].lower()
+    q = query.split('am')[0].split('pm')[0]
 
     if q.count(':') == 0:
         hr, _min, sec = force_int(q), 0, 0
@@ -316,100 +471,192 @@ def parse_time_timedelta(s: str):
     else:
         hr, _min, sec = 0, 0, 0
 
-    if 'pm' in query.lower() and int(hr) < 12:
+    if 'pm' in query and int(hr) < 12:
         hr = force_int(hr) + 12
 
     return datetime.timedelta(hours=force_int(hr), minutes=force_int(_min), seconds=force_int(sec))
 
 
-def ready(row):
+def parse_at_seconds(at: str) -> int | None:
+    q = at.split('am')[0].split('pm')[0]
+
+    if q.count(':') == 0:
+        hr, _min, sec = str(try_number(q, int, on_fail_return_value='0')).strip(), '0', '0'
+    elif q.count(':') == 1:
+        hr, _min = [x.strip() for x in q.split(':')]
+        sec = '0'
+    elif q.count(':') == 2:
+        hr, _min, sec = [x.strip() for x in q.split(':')]
+    else:
+        hr, _min, sec = '0', '0', '0'
+
     try:
-        # print('ready', row)
-        # t = row['time']
-        # _type = row['type']
-        query: str = row['query'].lower()
-
-        if '||' in query:
-            queries = query.split('||')
-            for q in queries:
-                if ready({**row, 'query': q.strip()}):
-                    return True
-            return False
-
-        last = (row['last'] + (row['last'].utcoffset() or datetime.timedelta(seconds=0))).timestamp()
-
-        if any([d in query for d in DAYS_OF_THE_WEEK]):
-            last = datetime.datetime.fromtimestamp(last, tz=datetime.timezone.utc)  # datetime.datetime.fromtimestamp(last, datetime.UTC)
-            now_utc = datetime.datetime.fromtimestamp(time.time(), tz=datetime.timezone.utc)  # datetime.datetime.now(datetime.UTC)
-            if abs((now_utc - last).days) < 5:  # can only run once a week
-                return False
-            if now_utc.strftime('%A').lower() in query:
-                if '@' in query:
-                    t = parse_time_timedelta(query)
-                    current_utc_time = datetime.timedelta(hours=now_utc.hour, minutes=now_utc.minute,
-                                                          seconds=now_utc.second)
-                    return current_utc_time >= t
-                return True
-            return False
-
-        if '@' not in query:
-            t = parse_time(row['query'])  # - 10.
-            # print('t', t, time.time() - last)
-            return time.time() - last > t
-        else:  # _type == '@':
-            time_to = parse_time(query.split('@')[0]) if any(
-                query.lower().startswith(f'{token} ') for token in STARTING_TOKENS
-            ) else 86400 - 30  # 'every' in query else 86400 - 30
-
-            query = query.split('@')[-1]
-            q = query.lower().split('am')[0].split('pm')[0]
-            if q.count(':') == 0:
-                hr, _min, sec = str(try_number(q, int, on_fail_return_value='0')).strip(), '0', '0'
-            elif q.count(':') == 1:
-                hr, _min, sec = tuple([*tuple(map(lambda s: s.strip(), q.split(':'))), '0'])
-            elif q.count(':') == 2:
-                hr, _min, sec = tuple(map(lambda s: s.strip(), q.split(':')))
-            elif q.count(':') == 1:
-                hr, _min, sec = tuple(q.split(':'))
-            else:
-                hr, _min, sec = '0', '0', '0'
-            if 'pm' in query.lower() and int(hr) < 12:
-                hr = str(int(hr) + 12)
-            # every 1 day @ 8:00:00 AM
-            # if '@' in query:
-            # hr, _min, sec = tuple(map(lambda s: s.strip(),
-            #     (query.split('@')[-1].lower().split('am')[0].split('pm')[0]).split(':')))
-            # if 'pm' in query.lower() and int(hr) < 12:
-            #     hr = str(int(hr) + 12)
-            force_zero = lambda x: '0' + f'{x}' if len(x) == 1 else f'{x}'
-            hr, _min, sec = force_zero(hr), force_zero(_min), force_zero(sec)
-            time_to_execute = datetime.datetime.strptime(
-                datetime.datetime.fromtimestamp(time.time(), tz=datetime.timezone.utc).strftime('%Y-%m-%d') + f' {hr}:{_min}:{sec}',
-                '%Y-%m-%d %H:%M:%S'
-            ).replace(tzinfo=datetime.timezone.utc)
-            # print('time_to_execute', time_to_execute, datetime.datetime.now(), time.time() - last, datetime.datetime.now().strftime('%Y-%m-%d') + f' {hr}:{_min}:{sec}')
-            days = math.floor((time_to-1) / 60 / 60 / 24)
-            datetime.datetime.fromtimestamp(last)
-            datetime.datetime.fromtimestamp(time.time())
-            enough_time_past = (datetime.datetime.fromtimestamp(time.time()) - datetime.timedelta(days=days)).date() > datetime.datetime.fromtimestamp(last).date()
-            return time_to_execute < datetime.datetime.fromtimestamp(time.time(), tz=datetime.timezone.utc) and enough_time_past  # time.time() - last > time_to
+        hr, _min, sec = int(hr), int(_min), int(sec)
+    except ValueError:
+        return None
+
+    if 'pm' in at and hr < 12:
+        hr += 12
+
+    if not (0 <= hr <= 23 and 0 <= _min <= 59 and 0 <= sec <= 59):
+        return None
+    return hr * 3600 + _min * 60 + sec
+
+
+def parse_schedule(query: str) -> Schedule:
+    # one scan for `@`, then slice the interval (head) and time of day (tail) parts
+    at_index = query.find('@')
+    has_at = at_index >= 0
+    head = query[:at_index] if has_at else query
+    tail = query[at_index + 1:] if has_at else ''
+
+    weekdays = frozenset(i for i, d in enumerate(DAYS_OF_THE_WEEK) if d in query)
+    if weekdays:
+        at = int(parse_time_timedelta(query).total_seconds()) if has_at else None
+        return Schedule(QueryKind.DAY, at=at, weekdays=weekdays)
+
+    if not has_at:
+        return Schedule(QueryKind.EVERY, interval=parse_time(query))
+
+    time_to = parse_time(head) if any(
+        query.startswith(f'{token} ') for token in STARTING_TOKENS
+    ) else SECONDS_PER_DAY - 30
+    return Schedule(
+        QueryKind.AT,
+        interval=time_to,
+        at=parse_at_seconds(tail),
+        days=math.floor((time_to - 1) / SECONDS_PER_DAY),
+    )
+
+
+# row id -> (query, schedule) so each query is only parsed when first seen or changed
+_SCHEDULES: dict[str, tuple[str, Schedule]] = {}
+
+
+def parse_query(query: str) -> Schedule:
+    q = query.lower()
+    if '||' in q:
+        return Schedule(QueryKind.OR, parts=tuple(parse_schedule(x.strip()) for x in q.split('||')))
+    return parse_schedule(q)
+
+
+def get_schedule(row) -> Schedule:
+    query = row['query']
+    cached = _SCHEDULES.get(row['id'])
+    if cached is None or cached[0] != query:
+        cached = _SCHEDULES[row['id']] = (query, parse_query(query))
+    return cached[1]
+
+
+def earliest_run(schedule: Schedule, last: float) -> float:
+    """
+    Epoch `ready` has to pass before it can be true, 0 for queries with a time of day or a weekday.
+    """
+    parts = schedule.parts if schedule.kind == QueryKind.OR else (schedule,)
+    if any(part.kind != QueryKind.EVERY for part in parts):
+        return 0
+    return last + min(part.interval for part in parts)
+
+
+def next_run_ts(row) -> int:
+    """
+    Earliest epoch at which `row` can be ready, stored in the `next_run_ts` column so the
+    poll only downloads rows that may be due. Queries with a time of day or a weekday return 0
+    and are checked by `ready` on every poll.
+    """
+    return math.floor(earliest_run(parse_query(row['query']), last_epoch(row)))
+
+
+# row id -> ((query, last), `earliest_run`) so rows that are not due skip `ready`
+_EARLIEST_RUNS: dict[str, tuple[tuple, float]] = {}
+
+
+def cached_earliest_run(row) -> float:
+    key = (row['query'], row['last'])
+    cached = _EARLIEST_RUNS.get(row['id'])
+    if cached is None or cached[0] != key:
+        try:
+            earliest = earliest_run(get_schedule(row), last_epoch(row))
+        except Exception:
+            earliest = 0  # let `ready` report it
+        cached = _EARLIEST_RUNS[row['id']] = (key, earliest)
+    return cached[1]
+
+
+def poll_time(now: float | None = None) -> PollTime:
+    now = time.time() if now is None else now
+    return PollTime(now, time.gmtime(now), int((now + time.localtime(now).tm_gmtoff) // SECONDS_PER_DAY))
+
+
+def last_epoch(row) -> float:
+    last = row['last']
+    if isinstance(last, str):  # sqlite hands datetimes back as iso strings
+        last = datetime.datetime.fromisoformat(last)
+    return (last + (last.utcoffset() or datetime.timedelta(seconds=0))).timestamp()
+
+
+def or_ready(schedule: Schedule, last: float, now: PollTime) -> bool:
+    return any(READY[part.kind](part, last, now) for part in schedule.parts)
+
+
+def day_ready(schedule: Schedule, last: float, now: PollTime) -> bool:
+    if -4 * SECONDS_PER_DAY <= now.epoch - last < 5 * SECONDS_PER_DAY:  # can only run once a week
+        return False
+    if now.utc.tm_wday not in schedule.weekdays:
+        return False
+    if schedule.at is not None:
+        return now.utc.tm_hour * 3600 + now.utc.tm_min * 60 + now.utc.tm_sec >= schedule.at
+    return True
+
+
+def at_ready(schedule: Schedule, last: float, now: PollTime) -> bool:
+    if schedule.at is None:
+        return False
+    last_local_day = int((last + time.localtime(last).tm_gmtoff) // SECONDS_PER_DAY)
+    enough_time_past = now.local_day - schedule.days > last_local_day
+    return schedule.at < now.epoch % SECONDS_PER_DAY and enough_time_past
+
+
+def every_ready(schedule: Schedule, last: float, now: PollTime) -> bool:
+    return now.epoch - last > schedule.interval
+
+
+# indexed by `QueryKind`
+READY = (or_ready, day_ready, at_ready, every_ready)
+
+
+def ready(row, now: PollTime | None = None):
+    try:
+        now = now or poll_time()
+        schedule = get_schedule(row)
+        return READY[schedule.kind](schedule, last_epoch(row), now)
     except Exception as e:
         print('error in ready', e)
         traceback.print_exc()
         return False
 
+
 def run(row):
-    module, func, args, kwargs = row['module'], row['func'], json.loads(row['args']), json.loads(row['kwargs'])
+    module, func = row['module'], row['func']
+    args, kwargs = cronevents.event_run.json_loads(row['args']), cronevents.event_run.json_loads(row['kwargs'])
     invoke(module, func, args, kwargs)
 
 
+def delete_event(db, event_id: str):
+    placeholder = '%s' if isinstance(db, buelon.helpers.postgres.Postgres) else '?'
+    db.query(f'delete from cronevents where id = {placeholder};', event_id)
+    _SCHEDULES.pop(event_id, None)
+    _EARLIEST_RUNS.pop(event_id, None)
+
+
 def update(row):
-    query = row['query']
-    if query.lower().strip().startswith('every'):
+    query = row['query'].lower().strip()
+    if query.startswith('every'):
         row['last'] = datetime.datetime.fromtimestamp(time.time(), tz=datetime.timezone.utc)  # datetime.datetime.now(datetime.UTC)  # time.time()
+        row['next_run_ts'] = next_run_ts(row)
         get_db().upload_table('cronevents', [row], id_column='id')
-    elif any(query.lower().strip().startswith(pre) for pre in ['in', 'on', 'this', 'next']):
-        get_db().query(f'delete from cronevents where id = \'{row["id"]}\'')
+    elif query.startswith(('in', 'on', 'this', 'next')):
+        delete_event(get_db(), row['id'])
 
 
 def event(query: str, module: str=None, func: str=None, args: list = None, kwargs: dict = None):
@@ -433,6 +680,7 @@ def event(query: str, module: str=None, func: str=None, args: list = None, kwarg
                 vals[0]['query'] = query
                 vals[0]['args'] = json.dumps(args or [])
                 vals[0]['kwargs'] = json.dumps(kwargs or {})
+                vals[0]['next_run_ts'] = next_run_ts(vals[0])
                 db.upload_table('cronevents', vals, id_column='id')
             else:
                 print('adding event', module, func)
@@ -441,25 +689,101 @@ def event(query: str, module: str=None, func: str=None, args: list = None, kwarg
     return __func
 
 
+_NEXT_RUN_INDEXED = False
+
+
+def index_next_run_ts(db):
+    global _NEXT_RUN_INDEXED
+    if _NEXT_RUN_INDEXED:
+        return
+    if isinstance(db, buelon.helpers.postgres.Postgres):
+        db.query('alter table cronevents add column if not exists next_run_ts bigint;')
+    elif 'next_run_ts' not in db.columns('cronevents'):
+        db.query('alter table cronevents add column next_run_ts;')
+    db.query('create index if not exists cronevents_next_run_idx on cronevents (next_run_ts);')
+    _NEXT_RUN_INDEXED = True
+
+
+def download_due_events(db, now: PollTime) -> list[dict]:
+    try:
+        index_next_run_ts(db)
+        return db.download_table(
+            sql=f'select * from cronevents where next_run_ts is null or next_run_ts <= {math.floor(now.epoch)}'
+        )
+    except buelon.helpers.postgres.psycopg2.errors.UndefinedTable:
+        raise
+    except Exception:
+        # e.g. a database that cannot add the `next_run_ts` column
+        return db.download_table('cronevents')
+
+
+def poll_delay(db, rows: list[dict]) -> float:
+    """
+    Seconds `main` can wait before the next event may be due.
+    """
+    if any(not row.get('next_run_ts') for row in rows):
+        # weekday/`@` events (and rows written before `next_run_ts` existed) are checked every poll
+        return POLL_INTERVAL
+    try:
+        result = db.query('select min(next_run_ts) from cronevents where next_run_ts > 0;')
+    except Exception:
+        return POLL_INTERVAL
+    upcoming = result[0][0] if result else None
+    if upcoming is None:
+        return MAX_POLL_DELAY
+    if upcoming <= time.time():
+        # already due but not moved on (`run`/`update` failed or it was edited by hand), do not spin on it
+        return POLL_INTERVAL
+    # `next_run_ts` is floored, `ready` needs strictly more than the interval to have passed
+    return min(max(upcoming + 1 - time.time(), MIN_POLL_DELAY), MAX_POLL_DELAY)
+
+
+def nudge():
+    """
+    Wake the event manager loop to poll now.
+    """
+    WAKE_UP.set()
+
+
 def main():
     print('version 0.0.31-alpha14')
+    start_dispatcher()
+    db_backoff = DB_MIN_BACKOFF
     while True:
+        delay = POLL_INTERVAL
         try:
-            for row in get_db().download_table('cronevents'):
+            db = get_db()
+            now = poll_time()
+            rows = download_due_events(db, now)
+            for row in rows:
                 try:
                     query_syntax_checker(row['query'])
-                    if ready(row):
+                    if now.epoch <= cached_earliest_run(row):
+                        continue
+                    if ready(row, now):
                         run(row)
                         update(row)
                 except CronEventSyntaxError:
-                    get_db().query(f'delete from cronevents where id = \'{row["id"]}\'')
-        except buelon.helpers.postgres.psycopg2.errors.UndefinedTable:
-            print('No events have been registered')
-            time.sleep(10.)
+                    delete_event(get_db(), row['id'])
+                except Exception as e:  # one bad row must not hold up the rest of the poll
+                    if is_db_connection_error(e) or is_missing_table_error(e):
+                        raise
+                    print('error running event', row['id'], '->', e)
+                    traceback.print_exc()
+            delay = poll_delay(db, rows)
+            db_backoff = DB_MIN_BACKOFF
         except Exception as e:
-            print('error ->', e)
-            traceback.print_exc()
-        time.sleep(2.)
+            if is_missing_table_error(e):
+                print('No events have been registered')
+                time.sleep(10.)
+            elif is_db_connection_error(e):
+                print('database connection error ->', e)
+                delay, db_backoff = db_backoff, min(db_backoff * 2, DB_MAX_BACKOFF)
+            else:
+                print('error ->', e)
+                traceback.print_exc()
+        WAKE_UP.wait(delay)
+        WAKE_UP.clear()
 
 
 if __name__ == '__main__':
@@ -1,4 +1,46 @@
-import os, sys, json, importlib
+import os, re, sys, json, base64, importlib
+
+try:  # optional, much faster than the standard library at reading json
+    import orjson
+except ImportError:
+    orjson = None
+
+# 19+ digit runs may be integers past 64 bits, which orjson reads back as floats
+_LONG_INT_RE = re.compile(r'\d{19}')
+_LONG_INT_RE_BYTES = re.compile(rb'\d{19}')
+
+
+def json_loads(s: str | bytes):
+    if orjson is not None and not (_LONG_INT_RE_BYTES if isinstance(s, bytes) else _LONG_INT_RE).search(s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:  # e.g. NaN/Infinity, which `json.dumps` writes
+            pass
+    return json.loads(s)
+
+
+JSON_ARG_PREFIX = 'b64:'  # args/kwargs passed inline as base64 json instead of a temp file path
+
+
+def load_json_arg(arg: str):
+    if arg.startswith(JSON_ARG_PREFIX):
+        return json_loads(base64.b64decode(arg[len(JSON_ARG_PREFIX):]))
+
+    with open(arg, "r") as f:
+        data = json_loads(f.read())
+    try:
+        os.remove(arg)
+    except Exception as e:
+        print('Error deleting ', arg, e)
+    return data
+
+
+def remove_json_arg(arg: str):
+    if not arg.startswith(JSON_ARG_PREFIX):
+        try:
+            os.remove(arg)
+        except:
+            pass
 
 
 def main():
@@ -10,20 +52,10 @@ def main():
         func = sys.argv[-3]
 
         # get args
-        with open(sys.argv[-2], "r") as f:
-            args = json.load(f)
-        try:
-            os.remove(sys.argv[-2])
-        except Exception as e:
-            print('Error deleting ', sys.argv[-2], e)
+        args = load_json_arg(sys.argv[-2])
 
         # get kwargs
-        with open(sys.argv[-1], "r") as f:
-            kwargs = json.load(f)
-        try:
-            os.remove(sys.argv[-1])
-        except Exception as e:
-            print('Error deleting ', sys.argv[-1], e)
+        kwargs = load_json_arg(sys.argv[-1])
 
         # print(module, func, args, kwargs)
 
@@ -37,14 +69,8 @@ def main():
             print(f"Function {func} not found in module {og_module}")
             # sys.exit(1)
     finally:
-        try:
-            os.remove(sys.argv[-2])
-        except:
-            pass
-        try:
-            os.remove(sys.argv[-1])
-        except:
-            pass
+        remove_json_arg(sys.argv[-2])
+        remove_json_arg(sys.argv[-1])
 
 
 if __name__ == "__main__":